@@ -4,13 +4,16 @@ import logging
 import traceback
 import base64
 import hashlib
-import librosa
-import audioread.ffdec
-import numpy as np
+import mmap
 import json
-from mutagen.mp4 import MP4, MP4Cover
+import re
+import functools
+import subprocess
 from io import BytesIO
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Heavy modules (numpy, numba, mutagen, PIL) are imported inside the
+# functions that need them, so runs served entirely from the cache start quickly
 
 # Configure logging to write errors to update_db.err
 logging.basicConfig(
@@ -29,15 +32,35 @@ sys.excepthook = global_exception_handler
 # Settings
 music_folder = "music"
 output_js = "music.js"
+mmap_threshold = 16 * 1024 * 1024  # Files larger than this are hashed via mmap
+decode_sample_rate = 22050  # Audio is decoded at this rate, enough for the amplitude envelope
+pipe_read_size = 256 * 1024  # Bytes read from FFmpeg per chunk
+title_date_pattern = re.compile(r"\((\d{4}\.\d{2}\.\d{2})\)\s*$")  # "(YYYY.MM.DD)" at the end of the title
+peak_block_size = 32  # Samples per block when streaming amplitudeData peaks
+use_numba = False  # Opt-in: fused Numba peak kernel, only pays off when each worker decodes many tracks
+exact_bin_blocks = 16  # Bins spanning fewer blocks than this are computed exactly from the retained samples
 
 def calculate_file_hash(filepath):
-    hash_func = hashlib.sha256()
     with open(filepath, "rb") as f:
-        while chunk := f.read(8192):
+        # Large files: hash a contiguous memory-mapped buffer in a single call
+        if os.fstat(f.fileno()).st_size > mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha256(mm).hexdigest()
+
+        # Python 3.11+: read/update loop runs in C
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+        # Fallback for older interpreters: read in 1 MiB chunks
+        hash_func = hashlib.sha256()
+        while chunk := f.read(1024 * 1024):
             hash_func.update(chunk)
-    return hash_func.hexdigest()
+        return hash_func.hexdigest()
 
 def extract_cover_base64(tags):
+    from mutagen.mp4 import MP4Cover
+    from PIL import Image
+
     covers = tags.get("covr")
     if covers:
         cover_data = covers[0]
@@ -51,6 +74,14 @@ def extract_cover_base64(tags):
         with Image.open(BytesIO(cover_bytes)) as img:
             width, height = img.size
 
+            # Square JPEG covers up to 512x512 are embedded as-is without re-encoding
+            if img.format == "JPEG" and width == height <= 512:
+                return base64.b64encode(cover_bytes).decode("utf-8")
+
+            # Let the JPEG decoder downscale while decoding (no-op for other formats)
+            img.draft("RGB", (512, 512))
+            width, height = img.size
+
             # Crop to 1:1 aspect ratio if needed
             if width != height:
                 min_edge = min(width, height)
@@ -60,12 +91,14 @@ def extract_cover_base64(tags):
                 bottom = top + min_edge
                 img = img.crop((left, top, right, bottom))
 
-            # Resize to 512x512
-            img = img.resize((512, 512), Image.Resampling.LANCZOS)
+            # Resize to 512x512 (reducing_gap box-reduces large covers before the LANCZOS pass)
+            img = img.resize((512, 512), Image.Resampling.LANCZOS, reducing_gap=2.0)
 
-            # Convert back to bytes (PNG format to preserve quality and transparency if any)
+            # Convert back to bytes (JPEG is much cheaper to encode than PNG)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
             buffered = BytesIO()
-            img.save(buffered, format="PNG")
+            img.save(buffered, format="JPEG", quality=85, subsampling=2, optimize=False, progressive=False)
             final_bytes = buffered.getvalue()
 
         # Encode to base64 and return string
@@ -73,92 +106,238 @@ def extract_cover_base64(tags):
 
     return None
 
+def decode_audio_mono(audio_path):
+    # Yield mono float32 chunks, decoded and downmixed by FFmpeg to raw 16-bit PCM
+    import numpy as np
+
+    cmd = [
+        "ffmpeg", "-nostdin", "-v", "quiet", "-i", audio_path,
+        "-f", "s16le", "-ac", "1", "-ar", str(decode_sample_rate), "-"
+    ]
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        while buf := proc.stdout.read(pipe_read_size):
+            yield np.frombuffer(buf, dtype="<i2").astype(np.float32) * (1 / 32768)
+
+    if proc.returncode:
+        raise RuntimeError(f"FFmpeg failed to decode {audio_path} (exit code {proc.returncode})")
+
+@functools.lru_cache(maxsize=None)
+def get_block_peaks():
+    # Returns a function mapping samples (a multiple of peak_block_size long) to the absolute peak of each block
+    # With use_numba enabled and numba installed abs and max are fused into a single pass, otherwise NumPy is used
+    import numpy as np
+
+    def numpy_block_peaks(samples):
+        return np.abs(samples).reshape(-1, peak_block_size).max(axis=1)
+
+    if not use_numba:
+        return numpy_block_peaks
+    try:
+        from numba import njit
+    except ImportError:
+        return numpy_block_peaks
+
+    # cache=True stores the compiled kernel on disk, so workers do not recompile it
+    @njit(nogil=True, fastmath=True, cache=True)
+    def block_peaks_kernel(samples, block_size, out):
+        for i in range(out.shape[0]):
+            peak = 0.0
+            for j in range(i * block_size, (i + 1) * block_size):
+                v = abs(samples[j])
+                if v > peak:
+                    peak = v
+            out[i] = peak
+
+    def block_peaks(samples):
+        out = np.empty(len(samples) // peak_block_size, dtype=np.float32)
+        block_peaks_kernel(samples, peak_block_size, out)
+        return out
+
+    return block_peaks
+
 def compute_amplitudeData(audio_path, target_length=200):
-    aro = audioread.ffdec.FFmpegAudioFile(audio_path)
-    y, sr = librosa.load(aro, sr=None, mono=True)
+    import numpy as np
+
+    block_peaks_func = get_block_peaks()
+
+    sr = decode_sample_rate
+    chunks = decode_audio_mono(audio_path)
+
+    # Reduce the stream to peaks of fixed-size blocks, so the full waveform is never held in memory
+    # Raw samples are only kept while the track is short enough for exact binning
+    exact_limit = target_length * peak_block_size * exact_bin_blocks
+    total_samples = 0
+    block_peaks = []
+    raw_chunks = []
+    carry = np.empty(0, dtype=np.float32)
+    for chunk in chunks:
+        total_samples += len(chunk)
+        if raw_chunks is not None:
+            if total_samples < exact_limit:
+                raw_chunks.append(chunk)
+            else:
+                raw_chunks = None
+        if carry.size:
+            chunk = np.concatenate((carry, chunk))
+        n = len(chunk) - len(chunk) % peak_block_size
+        if n:
+            block_peaks.append(block_peaks_func(chunk[:n]))
+        carry = chunk[n:]
+    if carry.size:
+        block_peaks.append(np.abs(carry).max(keepdims=True))
 
-    total_samples = len(y)
     samples_per_bin = total_samples // target_length
-    amplitudeData = []
+    n = samples_per_bin * target_length
 
-    for i in range(target_length):
-        start = i * samples_per_bin
-        end = start + samples_per_bin
-        bin_slice = y[start:end]
-        peak = float(np.max(np.abs(bin_slice))) if len(bin_slice) > 0 else 0.0
-        amplitudeData.append(peak)
+    if samples_per_bin > 0 and raw_chunks is not None:
+        # Short track: exact peak per bin (trailing samples are dropped)
+        y = np.concatenate(raw_chunks)
+        peaks = np.abs(y[:n]).reshape(target_length, samples_per_bin).max(axis=1)
+    elif samples_per_bin > 0:
+        # Combine block peaks into bins (bin edges are rounded down to block boundaries)
+        block_peaks = np.concatenate(block_peaks)[:-(-n // peak_block_size)]
+        starts = np.arange(target_length) * samples_per_bin // peak_block_size
+        peaks = np.maximum.reduceat(block_peaks, starts)
+    else:
+        peaks = np.zeros(target_length, dtype=np.float32)
 
     # normalize
-    max_peak = max(amplitudeData) if amplitudeData else 1.0
-    amplitudeData = [amp / max_peak for amp in amplitudeData]
+    peaks /= peaks.max() or 1.0
 
-    # Serialize amplitudeData list as JSON string
-    amplitudeData_json = json.dumps(amplitudeData)
+    # Quantize to one byte per bin and serialize as base64 string
+    amplitudeData_b64 = base64.b64encode(np.round(peaks * 255).astype(np.uint8).tobytes()).decode("utf-8")
 
     # Calculate duration in seconds
     durationSec = int(round(total_samples / sr))
 
-    return amplitudeData_json, durationSec
+    return amplitudeData_b64, durationSec
+
+def split_date_from_title(title):
+    # Returns the title without its trailing "(YYYY.MM.DD)" and the date, or the unchanged title and None
+    match = title_date_pattern.search(title) if title else None
+    if not match:
+        return title, None
+    return title[:match.start()].rstrip(), match.group(1)
+
+def load_previous_tracks():
+    # Rows of the last generated music.js keyed by filename, used as a cache
+    try:
+        with open(output_js, "r", encoding="utf-8") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return {}
+
+    try:
+        data = content[content.index("["):content.rindex("]") + 1]
+        rows = json.loads(data)
+        # Rows of unexpected shape or with JSON amplitudeData (an older format) are rebuilt
+        return {
+            row[0]: row for row in rows
+            if isinstance(row, list) and len(row) >= 12 and isinstance(row[0], str)
+            and isinstance(row[8], str) and not row[8].startswith("[")
+        }
+    except (ValueError, TypeError):
+        logging.error("Could not parse %s, rebuilding all tracks", output_js)
+        return {}
 
-def extract_date_from_title(title):
-    if not title:
-        return None
-    date_str = title[-12:].replace("(", "").replace(")", "")
-    return date_str
+def wrap_comment_in_paragraphs(comment):
+    if not comment:
+        return comment
+    # Split by line breaks, wrap each non-empty line in <p> tags, and join back with line breaks
+    return "".join(f"<p>{line}</p>\n" for line in comment.split("\r\n") if line.strip())
+
+def process_file(filename, file_hash, st):
+    # Runs in a worker process: tags, cover and amplitudeData for one already hashed file
+    from mutagen.mp4 import MP4
+
+    filepath = os.path.join(music_folder, filename)
+    audio = MP4(filepath)
+    tags = audio.tags
+    artist = tags.get("\xa9ART", [None])[0]
+    title = tags.get("\xa9nam", [None])[0]
+    genre = tags.get("\xa9gen", [None])[0]
+    comment = tags.get("\xa9cmt", [None])[0]
+
+    comment = wrap_comment_in_paragraphs(comment)
+    amplitudeData_b64, durationSec = compute_amplitudeData(filepath)
+    cover_b64 = extract_cover_base64(tags)
+    title, date = split_date_from_title(title)
+
+    return [
+        filename,
+        artist,
+        title,
+        date,
+        genre,
+        durationSec,
+        comment,
+        cover_b64,
+        amplitudeData_b64,
+        file_hash,
+        st.st_size,
+        st.st_mtime_ns
+    ]
 
 def main():
-    tracks = []
+    changed_files = []
+    stats = {}
+    previous_tracks = load_previous_tracks()
 
-    # Collect filenames
-    existing_files = [f for f in os.listdir(music_folder) if f.lower().endswith(".m4a")]
+    # Collect filenames with their stat info, sorted by filename descending
+    with os.scandir(music_folder) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(".m4a"):
+                stats[entry.name] = entry.stat()
+    existing_files = sorted(stats, reverse=True)
 
     for filename in existing_files:
-        filepath = os.path.join(music_folder, filename)
-        file_hash = calculate_file_hash(filepath)
-        if file_hash is None:
-            continue
-
-        audio = MP4(filepath)
-        tags = audio.tags
-        artist = tags.get("\xa9ART", [None])[0]
-        title = tags.get("\xa9nam", [None])[0]
-        genre = tags.get("\xa9gen", [None])[0]
-        comment = tags.get("\xa9cmt", [None])[0]
-
-        def wrap_comment_in_paragraphs(comment):
-            if not comment:
-                return comment
-            # Split by line breaks, wrap each non-empty line in <p> tags, and join back with line breaks
-            return "".join(f"<p>{line}</p>\n" for line in comment.split("\r\n") if line.strip())
-
-        comment = wrap_comment_in_paragraphs(comment)
-        amplitudeData_json, durationSec = compute_amplitudeData(filepath)
-        cover_b64 = extract_cover_base64(tags)
-        date = extract_date_from_title(title)
-        title = title[:-13] if title else None
-
-        tracks.append([
-            filename,
-            artist,
-            title,
-            date,
-            genre,
-            durationSec,
-            comment,
-            cover_b64,
-            amplitudeData_json,
-            file_hash
-        ])
-
-    # Sort by filename descending
-    tracks.sort(key=lambda x: x[0], reverse=True)
+        # Skip hashing and decoding if size and mtime match the previous run
+        st = stats[filename]
+        previous = previous_tracks.get(filename)
+        if not (previous and previous[10:12] == [st.st_size, st.st_mtime_ns]):
+            changed_files.append(filename)
+
+    # Hash stat-changed files in threads, hashlib releases the GIL while hashing
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+        paths = [os.path.join(music_folder, filename) for filename in changed_files]
+        hashes = dict(zip(changed_files, executor.map(calculate_file_hash, paths)))
 
     # Write to JS file
     # Reason for JS: it works serverless when site is accessed via file://
-    with open(output_js, "w", encoding="utf-8") as f:
-        f.write("const musicData = ")
-        json.dump(tracks, f, indent=2, ensure_ascii=False)
-        f.write(";\n")
+    # Written to a temporary file and swapped in at once, so an aborted run never leaves a partial music.js
+    tmp_js = output_js + ".tmp"
+
+    # Process files with new content in parallel, one worker per CPU core,
+    # and write each row as soon as it is due so not all tracks are held in memory
+    executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+    try:
+        with open(tmp_js, "w", encoding="utf-8") as f:
+            futures = {}
+            for filename, file_hash in hashes.items():
+                previous = previous_tracks.get(filename)
+                if not (previous and previous[9] == file_hash):
+                    futures[filename] = executor.submit(process_file, filename, file_hash, stats[filename])
+
+            f.write("const musicData = [\n")
+            for i, filename in enumerate(existing_files):
+                if filename in futures:
+                    row = futures.pop(filename).result()
+                else:
+                    # Unchanged content: reuse the previous row and refresh its size and mtime
+                    st = stats[filename]
+                    row = previous_tracks.pop(filename)[:10] + [st.st_size, st.st_mtime_ns]
+                if i:
+                    f.write(",\n")
+                json.dump(row, f, ensure_ascii=False)
+            f.write("\n];\n")
+        os.replace(tmp_js, output_js)
+    except BaseException:
+        # Drop queued files instead of waiting for them, and remove the partial output
+        executor.shutdown(cancel_futures=True)
+        if os.path.exists(tmp_js):
+            os.remove(tmp_js)
+        raise
+    executor.shutdown()
 
     print("music.js generated and sorted")
 
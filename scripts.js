@@ -146,6 +146,13 @@ const drawWaveform = (ctx, ampData, progress, width, height, hoverIndex = -1, is
   }
 };
 
+/**
+ * Decodes base64 amplitude data (one byte per bin) to values between 0 and 1
+ * @param {string} b64 - Base64 encoded uint8 amplitude data
+ * @returns {number[]} Amplitude data
+ */
+const decodeAmplitudeData = (b64) => Array.from(atob(b64), c => c.charCodeAt(0) / 255);
+
 /**
  * Interpolates amplitude data to a target length using linear interpolation
  * @param {number[]} inputData - Original amplitude data
@@ -430,11 +437,15 @@ const updateMediaSession = (idx, playbackState = 'none') => {
   const imgEl = track.container.querySelector('.track-cover-img');
   const artworkSrc = imgEl?.src || '';
 
+  // Covers up to 512x512 are embedded unscaled, so report the decoded size if known
+  const artwork = { src: artworkSrc, type: 'image/jpeg' };
+  if (imgEl?.naturalWidth) artwork.sizes = `${imgEl.naturalWidth}x${imgEl.naturalHeight}`;
+
   navigator.mediaSession.metadata = new MediaMetadata({
     title,
     artist,
     album: '',
-    artwork: artworkSrc ? [{ src: artworkSrc, sizes: '512x512', type: 'image/png' }] : []
+    artwork: artworkSrc ? [artwork] : []
   });
 
   // Normalize playbackState to 'playing' or 'paused' for loaded media
@@ -746,9 +757,9 @@ const togglePlay = async (directionOrIndex) => {
  * @returns {Object} Track object with references
  */
 const createTrackElement = (data, idx) => {
-  // Data shape: [filename, artist, title, date, genre, durationSec, detailsHTML, coverBase64, ampJSON, hash]
-  const [filename, artist, title, dateStr, genre, durationSec, detailsHTML, coverBase64, ampJSON] = data;
-  const ampData = JSON.parse(ampJSON);
+  // Data shape: [filename, artist, title, date, genre, durationSec, detailsHTML, coverBase64, ampBase64, hash, size, mtimeNs]
+  const [filename, artist, title, dateStr, genre, durationSec, detailsHTML, coverBase64, ampBase64] = data;
+  const ampData = decodeAmplitudeData(ampBase64);
 
   const trackItemDiv = document.createElement('div');
   trackItemDiv.className = 'track-item content';
@@ -770,7 +781,7 @@ const createTrackElement = (data, idx) => {
   const trackCoverImg = document.createElement('img');
   trackCoverImg.alt = `${title} cover art`;
   trackCoverImg.className = 'track-cover-img';
-  trackCoverImg.src = `data:image/png;base64,${coverBase64}`;
+  trackCoverImg.src = `data:image/jpeg;base64,${coverBase64}`;
 
   trackCoverLink.appendChild(trackCoverImg);
   trackCoverDiv.appendChild(trackCoverLink);